@@ -100,3 +100,47 @@ def init_GWorkSheet(env):
     return(worksheet)
 
 
+
+def format_GWorkSheet(worksheet):
+    ''' Format the header and the cells of the worksheet (if not already done) '''
+
+    header_format = {
+      "backgroundColor": {
+      "red": 55.0,
+      "green": 15.0,
+      "blue": 10.0
+      },
+      "horizontalAlignment": "LEFT",
+      "textFormat": { "fontSize": 11, "bold": True }
+    }
+
+    cells_format = {
+      "horizontalAlignment": "RIGHT",
+      "textFormat": { "fontSize": 11 }
+    }
+
+    # Get the current format of the first header cell and of the first cell
+    metadata = worksheet.spreadsheet.fetch_sheet_metadata(params={
+      "includeGridData": "true",
+      "ranges": ["'%s'!A1" %worksheet.title, "'%s'!A2" %worksheet.title],
+      "fields": "sheets.data.rowData.values.userEnteredFormat"
+    })
+
+    try:
+        grid = metadata['sheets'][0]['data']
+        header = grid[0]['rowData'][0]['values'][0]['userEnteredFormat']
+        cells = grid[1]['rowData'][0]['values'][0]['userEnteredFormat']
+    except (KeyError, IndexError):
+        header = {}
+        cells = {}
+
+    if (header.get('horizontalAlignment') == header_format['horizontalAlignment']) and \
+       (header.get('textFormat', {}).get('bold') == True) and \
+       (cells.get('horizontalAlignment') == cells_format['horizontalAlignment']):
+       print(colourise("green", "[INFO]"), \
+             "The worksheet is *already* formatted")
+    else:
+       worksheet.batch_format([
+         { "range": "A1:C1", "format": header_format },
+         { "range": "A2:C200", "format": cells_format }
+       ])
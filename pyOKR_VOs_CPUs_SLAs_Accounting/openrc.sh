@@ -26,6 +26,18 @@ export ACCOUNTING_VO_GROUP_SELECTOR="egi"
 # Available Data Selector: 'JSON', 'CSV'
 export ACCOUNTING_DATA_SELECTOR="JSON"
 
+# ACCOUNTING_CACHE=True, the records of closed periods are cached on disk
+# ACCOUNTING_CACHE=False (default), the records are always downloaded from the portal
+export ACCOUNTING_CACHE="True"
+#export ACCOUNTING_CACHE="False"
+export ACCOUNTING_CACHE_PATH=${HOME}"/.cache/pyOKR/"
+
+# Max. number of concurrent requests to the EGI Accounting Portal
+export ACCOUNTING_PARALLEL_REQUESTS="16"
+
+# Max. time (in seconds) to wait for the data from the EGI Accounting Portal
+export ACCOUNTING_TIMEOUT="300"
+
 export DATE_FROM="2024/07"
 export DATE_TO="2024/09"
 
@@ -15,14 +15,22 @@
 #  limitations under the License.
 #
 
+import asyncio
+import bisect
 import datetime
+import gspread
+import httpx
+import ijson
 import json
+import mmap
+import orjson
 import os
-import requests
+import shelve
+import sys
 import warnings
 warnings.filterwarnings("ignore")
 
-from gspreadutils import init_GWorkSheet, init_SLAs_GWorkSheet
+from gspreadutils import format_GWorkSheet, init_GWorkSheet, init_SLAs_GWorkSheet
 from utils import colourise, get_env_settings
 
 __author__    = "Giuseppe LA ROCCA"
@@ -33,102 +41,172 @@ __copyright__ = "Copyright (c) 2024 EGI Foundation"
 __license__   = "Apache Licence v2.0"
 
 
-def get_accounting_data(env, vo_name):
+async def get_accounting_data(client, semaphore, cache, url_prefix, url_suffix, vo_name):
 
     ''' Connecting to the EGI Accounting Portal '''
 
-    data = ""
-    _url = "%s/%s/%s/REGION/Year/%s/%s/custom-%s/%s/%s/" %(env['ACCOUNTING_SERVER_URL'], 
-            env['ACCOUNTING_SCOPE'],
-            env['ACCOUNTING_METRIC'],
-            env['DATE_FROM'], 
-            env['DATE_TO'],
-            vo_name,
-            env['ACCOUNTING_LOCAL_JOB_SELECTOR'],
-            env['ACCOUNTING_DATA_SELECTOR'])
+    data = {}
+    _url = url_prefix + "custom-" + vo_name + url_suffix
 
     headers = { "Accept": "Application/json" }
 
-    try:
-        curl = requests.get(url=_url, verify=True)
-        data = curl.json()
-    except ValueError:
-        pass
+    # Accounting records of a closed period are downloaded only once
+    if (cache is not None) and (_url in cache):
+       return _url, cache[_url]
+
+    async with semaphore:
+        try:
+            # Parse the records while they are streamed from the portal,
+            # keeping only the CPU/h of the providers and the total
+            records = ijson.sendable_list()
+            parser = ijson.items_coro(records, "item", use_float=True)
+            providers = []
+
+            async with client.stream("GET", _url, headers=headers) as curl:
+                async for chunk in curl.aiter_bytes():
+                    parser.send(chunk)
+                    for record in records:
+                        # Skip the legend records (without CPU/h)
+                        if "Total" not in record:
+                           continue
+
+                        record_id = record.get('id', "")
+                        if "Total" in record_id:
+                           data['Total'] = record['Total']
+                        elif "Percent" not in record_id:
+                           providers.append((record_id, record['Total']))
+                    del records[:]
+
+            parser.close()
+
+            if data:
+               data['providers'] = providers
+        except ijson.JSONError:
+            data = {}
+        except httpx.HTTPError as error:
+            print(colourise("red", "[ERROR]"), \
+                  "Failed to download the accounting records of the VO '%s' (%s)" \
+                  %(vo_name, repr(error)))
+            data = {}
+
+    if (cache is not None) and data:
+       cache[_url] = data
 
     return _url, data
 
 
+def is_closed_period(env):
+    ''' Check whether the reporting period is over (before the current month) '''
+
+    date_to = datetime.datetime.strptime(env['DATE_TO'], "%Y/%m")
+    first_of_current_month = datetime.datetime.now().replace(day=1, \
+            hour=0, minute=0, second=0, microsecond=0)
+
+    return(date_to < first_of_current_month)
+
+
+async def gather_accounting_data(env, url_prefix, url_suffix, VOs):
+    ''' Download the accounting records of the VOs concurrently '''
+
+    # Limit the number of requests in flight to the EGI Accounting Portal
+    semaphore = asyncio.Semaphore(int(env['ACCOUNTING_PARALLEL_REQUESTS']))
+
+    # Cache the accounting records on disk only when the period is closed
+    # (the version in the filename changes with the format of the cached records)
+    if ("True" in env['ACCOUNTING_CACHE']) and is_closed_period(env):
+       cache_path = os.path.expanduser(env['ACCOUNTING_CACHE_PATH'])
+       os.makedirs(cache_path, exist_ok=True)
+       cache = shelve.open(os.path.join(cache_path, "accounting-v1"))
+    else:
+       cache = None
+
+    # Pool the connections to the EGI Accounting Portal and retry the failed connects
+    transport = httpx.AsyncHTTPTransport(http2=True, verify=True, retries=3, \
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=32))
+
+    # The same VO can be listed under more SLAs: download its records only once
+    vo_names = list(dict.fromkeys(vo_details['Name'] for vo_details in VOs))
+
+    try:
+        # Share one client (and its connections) among all the requests
+        async with httpx.AsyncClient(transport=transport, \
+                timeout=httpx.Timeout(30.0, read=float(env['ACCOUNTING_TIMEOUT']))) as client:
+            results = await asyncio.gather(
+                    *(get_accounting_data(client, semaphore, cache, url_prefix, url_suffix, vo_name) \
+                    for vo_name in vo_names))
+    finally:
+        if cache is not None:
+           cache.close()
+
+    records = dict(zip(vo_names, results))
+
+    return [records[vo_details['Name']] for vo_details in VOs]
 
-def get_GWorkSheetCellPosition(worksheet, accounting_period):
+
+
+def get_GWorkSheetCellPosition(periods, accounting_period):
     ''' Get the cell coordinates where to add the new reporting period '''
 
     found = False
     pos = 2
     
-    values_list = worksheet.col_values(1)
+    if len(periods) > 1:
+       # The reporting periods are sorted in the gspread (col=1)
+       sorted_periods = [header for header in periods if "Period" not in header]
 
-    if len(values_list) > 1:
-       for header in values_list:
-           if ("Period" not in header):
-           
-              if (header == accounting_period) or (header == ""):
-                 found = True
-                 break
+       # An empty row is re-used for the new reporting period
+       if "" in sorted_periods:
+          sorted_periods = sorted_periods[:sorted_periods.index("")]
+          found = True
 
-              if header < accounting_period:
-                 pos = pos + 1
+       index = bisect.bisect_left(sorted_periods, accounting_period)
+       if (index < len(sorted_periods)) and (sorted_periods[index] == accounting_period):
+          found = True
+
+       pos = pos + index
 
     return(pos, found)
 
 
 
-def get_vo_cell(worksheet, vo_name):
-    ''' Insert the "vo_name" in the gspread if not present '''
+def get_vo_cell(header_map, vo_name):
+    ''' Get the column of "vo_name" in the headers, adding it if not present '''
 
-    found = False
-    vo_name_pos = 2
-   
-    # Get the full list of the headers in the gspread (row=1)
-    values_list = worksheet.row_values(1)
-    
-    if len(values_list) > 1:
-       for header in values_list:
-           if ("Period" not in header):
-              if (header == vo_name) or (header == ""):
-                 found = True
-                 break
-              else:
-                 vo_name_pos = vo_name_pos + 1
+    vo_name_pos = header_map.get(vo_name)
+    found = vo_name_pos is not None
     
     if not found:
+       # New VOs are appended after the last column of the headers
+       vo_name_pos = max(header_map.values(), default=1) + 1
+
        print(colourise("green", "[INFO]"), \
              "Adding '%s' at column: %d" %(vo_name, vo_name_pos))
       
-       worksheet.insert_cols(
-               [[vo_name]],
-               vo_name_pos,
-               value_input_option='RAW',
-               inherit_from_before=False)
+       # Keep the cached headers aligned with the (deferred) gspread update
+       header_map[vo_name] = vo_name_pos
     
     else:   
        print(colourise("green", "[INFO]"), \
              "The vo '%s' is *already* in the gspread at position: %s" %(vo_name, str(vo_name_pos)))
 
-    return(vo_name_pos)  
+    return(vo_name_pos, found)  
 
 
-def update_GWorkSheet(env, worksheet, accounting_period_pos, vo_name_pos, total_vo_cpu):
-    ''' Update the accounting records in the Google Worksheet '''
+def update_GWorkSheet(is_cloud, pending, accounting_period_pos, vo_name_pos, total_vo_cpu):
+    ''' Queue the accounting records to be updated in the Google Worksheet '''
 
-    # Update the Google Worksheet cell (with the 'CPU/h' in the reporting period)
-    worksheet.update_cell(accounting_period_pos, vo_name_pos, total_vo_cpu)
+    # Queue the Google Worksheet cell (with the 'CPU/h' in the reporting period)
+    pending.append({
+        "range": gspread.utils.rowcol_to_a1(accounting_period_pos, vo_name_pos),
+        "values": [[total_vo_cpu]]
+    })
 
-    if env['ACCOUNTING_SCOPE'] == "cloud":
+    if is_cloud:
        print(colourise("green", "[INFO]"), \
-             "Updated the total Cloud CPU/h for the VO")
+             "Queued the total Cloud CPU/h for the VO")
     else:
        print(colourise("green", "[INFO]"), \
-             "Updated the total HTC CPU/h for the VO")
+             "Queued the total HTC CPU/h for the VO")
 
 
 def getting_SLAs_metadata(env, SLAs_worksheet):
@@ -181,9 +259,9 @@ def getting_SLAs_metadata(env, SLAs_worksheet):
            if len(vo) > 0:
                vos.append(vo) 
      
-    # Saving active SLAs with metadata
+    # Saving active SLAs with metadata (same layout of the VOs_FILE)
     with open(env['VOs_FILE'], 'w', encoding='utf-8') as f:
-         json.dump(vos, f, ensure_ascii=False, indent=4)
+         json.dump([{ "vos": [{ "vo": vos }] }], f, ensure_ascii=False, indent=4)
 
 
 def main():
@@ -198,12 +276,17 @@ def main():
 
     env = get_env_settings()
     log = env['LOG']
+    log_debug = "DEBUG" in log
+    scope = env['ACCOUNTING_SCOPE']
+    date_from = env['DATE_FROM']
+    date_to = env['DATE_TO']
+    is_cloud = "cloud" in scope
     print("\nLog Level = %s" %colourise("cyan", log))
 
-    print(colourise("green", "\n[%s]" %env['LOG']), "Environmental settings")
+    print(colourise("green", "\n[%s]" %log), "Environmental settings")
     print(json.dumps(env, indent=4))
 
-    accounting_period = env['DATE_FROM'][0:4] + "." + env['DATE_FROM'][-2:] + "-" + env['DATE_TO'][-2:]
+    accounting_period = date_from[0:4] + "." + date_from[-2:] + "-" + date_to[-2:]
 
     # Initialise the GWorkSheet
     worksheet = init_GWorkSheet(env)
@@ -214,26 +297,17 @@ def main():
     # Getting start_date, end_date of the active SLAs from the EGI_VOs_SLAs_OLAs_dashboard
     #getting_SLAs_metadata(env, SLAs_worksheet)
 
-    # Formatting the header of the worksheet
-    worksheet.format("A1:C1", {
-      "backgroundColor": {
-      "red": 55.0,
-      "green": 15.0,
-      "blue": 10.0
-      },
-      "horizontalAlignment": "LEFT",
-      "textFormat": { "fontSize": 11, "bold": True }
-    })
+    # Formatting the header and the cells of the worksheet
+    format_GWorkSheet(worksheet)
 
-    # Formatting the cells of the worksheet
-    worksheet.format("A2:C200", {
-      "horizontalAlignment": "RIGHT",
-      "textFormat": { "fontSize": 11 }
-    })
+    # Get the reporting periods (col=1) and the headers (row=1) of the gspread
+    periods = worksheet.col_values(1)
+    header_map = {header: index + 1 \
+            for index, header in enumerate(worksheet.row_values(1)) if header}
 
     # Check the Headers of the gspread
     # 1.) Check whether the 'accounting_period' is already in the gspread
-    accounting_period_pos, found_position = get_GWorkSheetCellPosition(worksheet, accounting_period)
+    accounting_period_pos, found_position = get_GWorkSheetCellPosition(periods, accounting_period)
     
     if (not found_position):
         print(colourise("cyan", "\n[INFO]"), \
@@ -246,74 +320,117 @@ def main():
               "The accounting_period *ALREADY FOUND* in the gspread at row: %s " \
               %accounting_period_pos)
 
-    print(colourise("green", "\n[%s]" %env['LOG']), \
+    print(colourise("green", "\n[%s]" %log), \
     "Downloading accounting records from the EGI Accouting Portal in progress...")
     print("\tThis operation may take few minutes to complete. Please wait!")
 
     # Load VOs metadata in JSON format
-    VOs_file = open(env['VOs_FILE'])
-    VOs = json.load(VOs_file)
-
-    for vo_details in VOs:
-        if (env['ACCOUNTING_SCOPE'] in vo_details['Type']) and \
-           (env['DATE_FROM'] >= vo_details['SLA_start']) and \
-           (env['DATE_TO'] <= vo_details['SLA_end']) and \
-            vo_details['Active'] == "Y":
-            _url, data = get_accounting_data(env, vo_details['Name'])
-
-            try:
-                if data:
-                    print(colourise("cyan", "\n[INFO]"), \
-                    " Fetching the accounting records for the VO [%s] in progress..." %vo_details['Name'].upper())
-                  
-                    if "DEBUG" in env['LOG']:
-                       print(_url, data)
+    with open(env['VOs_FILE'], "rb") as VOs_file, \
+         mmap.mmap(VOs_file.fileno(), 0, access=mmap.ACCESS_READ) as VOs_map, \
+         memoryview(VOs_map) as VOs_view:
+         VOs = orjson.loads(VOs_view)
+
+    # Cells to be updated in the gspread with a single batch request
+    pending = []
+
+    # Flatten the VOs metadata (lazily, it is consumed once by the selection below)
+    all_details = (details for VO_items in VOs \
+            for vo_details in VO_items['vos'] \
+            for details in vo_details['vo'])
+
+    # Select the VOs with an active SLA in the reporting period
+    eligible = [details for details in all_details \
+            if (scope in details['Type']) and \
+               (date_from >= details['SLA_start']) and \
+               (date_to <= details['SLA_end']) and \
+                details['Active'] == "Y"]
+
+    # The URLs of the EGI Accounting Portal only differ by the VO name
+    url_prefix = f"{env['ACCOUNTING_SERVER_URL']}/{scope}/{env['ACCOUNTING_METRIC']}" \
+                 f"/REGION/Year/{date_from}/{date_to}/"
+    url_suffix = f"/{env['ACCOUNTING_LOCAL_JOB_SELECTOR']}/{env['ACCOUNTING_DATA_SELECTOR']}/"
+
+    # Download the accounting records of all the VOs concurrently
+    results = asyncio.run(gather_accounting_data(env, url_prefix, url_suffix, eligible))
+
+    for vo_details, (_url, data) in zip(eligible, results):
+        try:
+            if data:
+                lines = ["%s  Fetching the accounting records for the VO [%s] in progress..." \
+                        %(colourise("cyan", "\n[INFO]"), vo_details['Name'].upper())]
+              
+                # The CPU/h of the providers are only logged in DEBUG mode
+                if log_debug:
+                   lines.append("%s %s" %(_url, data))
+                   
+                   for provider, provider_cpu in data['providers']:
+                       lines.append("- Provider: %s; CPU/h: %s" %(provider, format(provider_cpu,"7,d")))
+
+                fmt_total = format(data['Total'],"7,d")
+
+                if is_cloud:
+                    lines.append("- Total Cloud CPU/h = %s" %fmt_total)
+                else:
+                    lines.append("- Total HTC CPU/h = %s" %fmt_total)
+
+                sys.stdout.write("\n".join(lines) + "\n")
+
+                vo_details['CPU/h'] = (int(vo_details['CPU/h']) + data['Total'])
+                total_cpu = total_cpu + data['Total']
+
+                # 2.) Check whether the 'vo_name' is already in the headers of the gspread
+                vo_name_pos, found_vo = get_vo_cell(header_map, vo_details['Name'])
+
+                if not found_vo:
+                   pending.append({
+                       "range": gspread.utils.rowcol_to_a1(1, vo_name_pos),
+                       "values": [[vo_details['Name']]]
+                   })
                        
-                    for record in data:
-                        if "Percent" not in record['id'] and "Total" not in record['id']:
-                            print("- Provider: %s; CPU/h: %s" %(record['id'], format(record['Total'],"7,d")))
-                        if "Total" in record['id']:
-                            if "cloud" in env['ACCOUNTING_SCOPE']:
-                                print("- Total Cloud CPU/h = %s" %format(record['Total'],"7,d"))
-                            else:
-                                print("- Total HTC CPU/h = %s" %format(record['Total'],"7,d"))
-
-                            vo_details['CPU/h'] = (int(vo_details['CPU/h']) + record['Total'])
-                            total_cpu = total_cpu + record['Total']
-
-                            # 2.) Check whether the 'vo_name' is already in the headers of the gspread
-                            vo_name_pos = get_vo_cell(worksheet, vo_details['Name'])
-                                   
-                            #Update the CPU/h for the given VO in the gspread
-                            update_GWorkSheet(env, 
-                                    worksheet, 
-                                    accounting_period_pos, 
-                                    vo_name_pos,
-                                    format(record['Total'],"7,d"))
-
-            except (KeyError):
-                pass
+                #Update the CPU/h for the given VO in the gspread
+                update_GWorkSheet(is_cloud, 
+                        pending, 
+                        accounting_period_pos, 
+                        vo_name_pos,
+                        fmt_total)
+
+        except (KeyError):
+            pass
 
     total_cpu = format(total_cpu,"7,d")                   
 
     print(colourise("green", "\n[REPORT]"))
-    if "cloud" in env['ACCOUNTING_SCOPE']:
+    if is_cloud:
        print("- Cloud CPU/h consumed by the EGI SLAs")
-       print("- Reporting period = %s - %s" %(env['DATE_FROM'], env['DATE_TO']))
+       print("- Reporting period = %s - %s" %(date_from, date_to))
        print("- Total = %s Cloud CPU/h" %total_cpu.strip())
     else:
        print("- HTC CPU/h consumed by the EGI SLAs")
-       print("- Reporting period = %s - %s" %(env['DATE_FROM'], env['DATE_TO']))
+       print("- Reporting period = %s - %s" %(date_from, date_to))
        print("- Total = %s HTC CPU/h" %total_cpu.strip())
 
     # Update the Total CPU/h consumed in the reporting period
-    total_cell = worksheet.find("TOTAL")
-    update_GWorkSheet(env,
-            worksheet,
+    if "TOTAL" in header_map:
+       total_col = header_map["TOTAL"]
+    else:
+       total_col = worksheet.find("TOTAL").col
+
+    update_GWorkSheet(is_cloud,
+            pending,
             accounting_period_pos,
-            total_cell.col,
+            total_col,
             total_cpu.strip())
 
+    # Add the missing columns for the new VOs (if any)
+    missing_cols = max(header_map.values(), default=1) - worksheet.col_count
+    if missing_cols > 0:
+       worksheet.add_cols(missing_cols)
+
+    # Push all the queued updates to the gspread in a single request
+    worksheet.batch_update(pending, value_input_option='USER_ENTERED')
+    print(colourise("green", "[INFO]"), \
+          "Updated %d cells in the gspread" %len(pending))
+
     # Update the timestamp of the last update
     worksheet.insert_note("A1","Last update on: " + timestamp)  
 
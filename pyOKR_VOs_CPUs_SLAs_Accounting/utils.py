@@ -152,6 +152,12 @@ def get_env_settings():
 
         except Exception:
           print(colourise("red", "ERROR: os.environment settings not found!"))
+
+        # Optional settings (with defaults)
+        d['ACCOUNTING_CACHE'] = os.environ.get('ACCOUNTING_CACHE', "False")
+        d['ACCOUNTING_CACHE_PATH'] = os.environ.get('ACCOUNTING_CACHE_PATH', "~/.cache/pyOKR/")
+        d['ACCOUNTING_PARALLEL_REQUESTS'] = os.environ.get('ACCOUNTING_PARALLEL_REQUESTS', "16")
+        d['ACCOUNTING_TIMEOUT'] = os.environ.get('ACCOUNTING_TIMEOUT', "300")
         
         return d
 